@@ -1,14 +1,23 @@
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.api_core.exceptions import AlreadyExists
 import json
 import base64
 import logging
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Máximo de operaciones que admite un WriteBatch de Firestore
+BATCH_LIMIT = 500
+# Códigos gRPC transitorios que el BulkWriter reintenta, y número máximo de intentos
+BULK_RETRYABLE_CODES = {4, 8, 10, 13, 14}  # DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE
+BULK_MAX_ATTEMPTS = 10
+
 class FirebaseUtils:
     def __init__(self):
         self.db = None
@@ -39,6 +48,24 @@ class FirebaseUtils:
             logger.error(f"Error fatal al inicializar Firebase: {e}")
             raise
 
+    def _bulk_writer(self):
+        """
+        Crea un BulkWriter que reintenta solo los errores transitorios. close() no lanza
+        excepción por las escrituras que fallan, así que se devuelven también las
+        (id, mensaje) de los documentos fallidos para comprobarlas tras cerrarlo.
+        """
+        failures = []
+
+        def on_write_error(error, bulk_writer):
+            if error.code in BULK_RETRYABLE_CODES and error.attempts < BULK_MAX_ATTEMPTS:
+                return True
+            failures.append((error.operation.reference.id, error.message))
+            return False
+
+        bulk_writer = self.db.bulk_writer()
+        bulk_writer.on_write_error(on_write_error)
+        return bulk_writer, failures
+
     def get_timestamp(self):
         """Retorna el timestamp actual en formato ISO."""
         return datetime.now().isoformat()
@@ -51,12 +78,15 @@ class FirebaseUtils:
         """
         try:
             collection_ref = self.db.collection('inventory')
+            # 'timestamp' se calcula localmente; el servidor añade su propia marca al escribir
+            data = {**data, 'server_ts': firestore.SERVER_TIMESTAMP}
             
             if custom_id:
-                doc_ref = collection_ref.document(custom_id)
-                if doc_ref.get().exists:
+                # create() falla si el documento ya existe: una sola llamada en lugar de get() + set()
+                try:
+                    collection_ref.document(custom_id).create(data)
+                except AlreadyExists:
                     raise ValueError(f"El ID personalizado '{custom_id}' ya existe en el inventario.")
-                doc_ref.set(data)
                 logger.info(f"Elemento guardado con ID personalizado: {custom_id}")
                 return custom_id
             else:
@@ -68,10 +98,66 @@ class FirebaseUtils:
             logger.error(f"Error al guardar en Firestore: {e}")
             raise
 
-    def get_all_inventory_items(self):
-        """Obtiene todos los elementos de la colección 'inventory'."""
+    def save_inventory_items_bulk(self, items):
+        """
+        Guarda varios elementos en la colección 'inventory' mediante WriteBatch de hasta
+        500 operaciones, confirmando los lotes en paralelo.
+        Los elementos con 'custom_id' lo usan como ID del documento, previa verificación
+        de que no exista ni se repita dentro del lote. Devuelve la lista de IDs guardados.
+        """
+        try:
+            collection_ref = self.db.collection('inventory')
+            custom_ids = [item['custom_id'] for item in items if item.get('custom_id')]
+            repeated = sorted({cid for cid in custom_ids if custom_ids.count(cid) > 1})
+            if repeated:
+                raise ValueError(f"IDs personalizados repetidos en el lote: {', '.join(repeated)}")
+
+            refs = [
+                collection_ref.document(item['custom_id']) if item.get('custom_id') else collection_ref.document()
+                for item in items
+            ]
+            custom_refs = [ref for ref, item in zip(refs, items) if item.get('custom_id')]
+            existing = [snap.id for snap in self.db.get_all(custom_refs) if snap.exists] if custom_refs else []
+            if existing:
+                raise ValueError(f"Los IDs personalizados ya existen en el inventario: {', '.join(existing)}")
+
+            batches = []
+            for start in range(0, len(items), BATCH_LIMIT):
+                batch = self.db.batch()
+                for ref, item in zip(refs[start:start + BATCH_LIMIT], items[start:start + BATCH_LIMIT]):
+                    batch.create(ref, {**item, 'server_ts': firestore.SERVER_TIMESTAMP})
+                batches.append(batch)
+
+            with ThreadPoolExecutor(max_workers=min(40, len(batches) or 1)) as executor:
+                list(executor.map(lambda batch: batch.commit(), batches))
+            logger.info(f"{len(items)} elementos guardados en {len(batches)} lote(s).")
+            return [ref.id for ref in refs]
+
+        except Exception as e:
+            logger.error(f"Error al guardar el lote en Firestore: {e}")
+            raise
+
+    def get_all_inventory_items(self, limit=None, start_after=None):
+        """
+        Obtiene los elementos de la colección 'inventory'.
+        Si se indica `limit`, devuelve solo una página ordenada por 'timestamp' descendente
+        y por ID de documento como desempate, empezando después del cursor `start_after`,
+        una tupla (timestamp, id) del último elemento de la página anterior.
+        Los documentos sin 'timestamp' no aparecen en la consulta ordenada; ver
+        backfill_missing_timestamps().
+        """
         try:
-            docs = self.db.collection('inventory').stream()
+            collection = self.db.collection('inventory')
+            query = collection
+            if limit:
+                query = (query.order_by('timestamp', direction=firestore.Query.DESCENDING)
+                              .order_by('__name__', direction=firestore.Query.DESCENDING))
+                if start_after:
+                    timestamp, doc_id = start_after
+                    query = query.start_after({'timestamp': timestamp, '__name__': collection.document(doc_id)})
+                query = query.limit(limit)
+
+            docs = query.stream()
             items = []
             for doc in docs:
                 item = doc.to_dict()
@@ -82,6 +168,47 @@ class FirebaseUtils:
             logger.error(f"Error al obtener datos de Firestore: {e}")
             return []
 
+    def backfill_missing_timestamps(self):
+        """
+        Asigna 'timestamp' a los documentos de 'inventory' que no lo tienen, para que
+        aparezcan en el listado paginado (Firestore excluye de un order_by los documentos
+        sin ese campo). Se usa la fecha de creación del documento en Firestore, no la hora
+        actual, para no presentarlos como registros recientes. Es una migración puntual que
+        se lanza a mano desde la Base de Datos. Devuelve cuántos se actualizaron.
+        """
+        try:
+            collection = self.db.collection('inventory')
+            missing = [doc for doc in collection.select(['timestamp']).stream()
+                       if 'timestamp' not in doc.to_dict()]
+            if missing:
+                bulk_writer, failures = self._bulk_writer()
+                for doc in missing:
+                    # Mismo formato que get_timestamp(): ISO en hora local, sin zona horaria
+                    created = doc.create_time.astimezone().replace(tzinfo=None).isoformat()
+                    bulk_writer.update(doc.reference, {'timestamp': created})
+                bulk_writer.close()
+                if failures:
+                    raise ValueError(f"No se pudo asignar timestamp a: {', '.join(f'{doc_id} ({msg})' for doc_id, msg in failures)}")
+                logger.info(f"Se asignó timestamp a {len(missing)} elemento(s) sin él.")
+            return len(missing)
+        except Exception as e:
+            logger.error(f"Error al completar timestamps en Firestore: {e}")
+            raise
+
+    def count_by_tipo(self, tipos=None):
+        """
+        Cuenta los elementos de 'inventory' con una agregación count() en el servidor,
+        sin descargar los documentos. Si se indican `tipos`, solo cuenta los de esos tipos.
+        """
+        try:
+            query = self.db.collection('inventory')
+            if tipos:
+                query = query.where(filter=FieldFilter('tipo', 'in', list(tipos)))
+            return query.count().get()[0][0].value
+        except Exception as e:
+            logger.error(f"Error al contar elementos en Firestore: {e}")
+            raise
+
     def delete_inventory_item(self, doc_id):
         """Elimina un elemento por su ID de documento."""
         try:
@@ -90,3 +217,22 @@ class FirebaseUtils:
         except Exception as e:
             logger.error(f"Error al eliminar de Firestore: {e}")
             raise
+
+    def bulk_delete(self, doc_ids):
+        """
+        Elimina varios elementos por su ID de documento con un BulkWriter de Firestore,
+        que envía los borrados en paralelo y reintenta los fallos transitorios.
+        Lanza ValueError con los IDs que no se pudieron eliminar.
+        """
+        try:
+            bulk_writer, failures = self._bulk_writer()
+            collection = self.db.collection('inventory')
+            for doc_id in doc_ids:
+                bulk_writer.delete(collection.document(doc_id))
+            bulk_writer.close()  # Espera a que terminen todos los borrados
+            if failures:
+                raise ValueError(f"No se pudieron eliminar: {', '.join(f'{doc_id} ({msg})' for doc_id, msg in failures)}")
+            logger.info(f"{len(doc_ids)} elementos eliminados.")
+        except Exception as e:
+            logger.error(f"Error al eliminar en lote de Firestore: {e}")
+            raise
@@ -3,10 +3,60 @@ import logging
 from PIL import Image
 import streamlit as st
 import json
+import io
+import threading
+import time
+from collections import OrderedDict
+from typing import Union
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def compress_for_gemini(image: Image.Image, max_side: int = 1024, quality: int = 85) -> bytes:
+    """
+    Reduce la imagen a un lado máximo de `max_side` px y la codifica en JPEG para enviarla a Gemini.
+    No modifica la imagen recibida. BILINEAR basta para un modelo de visión y es bastante más barato que LANCZOS.
+    """
+    if max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=quality, optimize=True)
+    return buf.getvalue()
+
+class AnalysisCache:
+    """
+    Caché LRU acotada y segura entre hilos para las respuestas de Gemini.
+    Permite reutilizar un análisis ya pagado aunque la respuesta se haya recibido en streaming.
+    Las entradas caducan a los `ttl` segundos (None para no caducar).
+    """
+
+    def __init__(self, max_entries=64, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            stored_at, value = self._items[key]
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
 class GeminiUtils:
     def __init__(self):
         self.api_key = st.secrets.get('GEMINI_API_KEY')
@@ -39,10 +89,9 @@ class GeminiUtils:
         
         raise Exception("No se pudo inicializar ningún modelo de visión de Gemini compatible.")
     
-    def analyze_image(self, image_pil: Image, description: str = ""):
-        """Analiza una imagen PIL y devuelve una respuesta JSON."""
-        try:
-            prompt = f"""
+    def _build_prompt(self, description: str = ""):
+        """Construye el prompt de análisis de inventario para Gemini."""
+        return f"""
             Analiza esta imagen de un objeto de inventario.
             Descripción adicional: "{description}"
             
@@ -64,14 +113,35 @@ class GeminiUtils:
             
             IMPORTANTE: Tu respuesta debe ser solo el objeto JSON, sin incluir ```json al principio o al final.
             """
-            
-            response = self.model.generate_content([prompt, image_pil])
-            
-            if response and response.text:
-                return response.text.strip()
-            else:
-                return json.dumps({"error": "No se pudo analizar la imagen"})
-                
+
+    def _prepare_image(self, image: Union[bytes, Image.Image]):
+        """
+        Convierte la imagen en el blob que recibe Gemini.
+        Los bytes ya codificados (p. ej. de compress_for_gemini) se envían tal cual; una
+        imagen PIL se codifica una sola vez en JPEG en lugar de dejar que el cliente la
+        vuelva a codificar.
+        """
+        if isinstance(image, (bytes, bytearray)):
+            data = bytes(image)
+            mime_type = "image/webp" if data[8:12] == b"WEBP" else "image/jpeg"
+            return {"mime_type": mime_type, "data": data}
+
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        buf = io.BytesIO()
+        image.save(buf, 'JPEG', quality=85)
+        return {"mime_type": "image/jpeg", "data": buf.getvalue()}
+
+    def analyze_image_stream(self, image: Union[bytes, Image.Image], description: str = ""):
+        """
+        Analiza una imagen (PIL o bytes codificados) usando la API en streaming de Gemini.
+        Entrega los fragmentos de texto a medida que llegan.
+        """
+        try:
+            response = self.model.generate_content([self._build_prompt(description), self._prepare_image(image)], stream=True)
+            for chunk in response:
+                if chunk.text:
+                    yield chunk.text
         except Exception as e:
-            logger.error(f"Error al analizar imagen con Gemini: {e}")
-            return json.dumps({"error": f"Error en el análisis de Gemini: {str(e)}"})
+            logger.error(f"Error al analizar imagen con Gemini (streaming): {e}")
+            yield json.dumps({"error": f"Error en el análisis de Gemini: {str(e)}"})
@@ -1,16 +1,21 @@
 import streamlit as st
 from PIL import Image
 import numpy as np
-import cv2
-import pandas as pd
-import plotly.express as px
 import json
+import io
+import os
+import shutil
+import hashlib
+import logging
+from pathlib import Path
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 # Importa las clases que creaste
 from firebase_utils import FirebaseUtils
-from gemini_utils import GeminiUtils
-from ultralytics import YOLO
+from gemini_utils import GeminiUtils, AnalysisCache, compress_for_gemini
+# ultralytics, torch, cv2, pandas y plotly se importan dentro de las funciones o páginas que
+# los usan: Inicio, Base de Datos y Acerca de no pagan su tiempo de importación
 
 # --- CONFIGURACIÓN DE PÁGINA Y ESTILOS ---
 st.set_page_config(
@@ -29,23 +34,361 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+logger = logging.getLogger(__name__)
+
+# yolov8n es el modelo por defecto (~3x menos parámetros); yolov8m queda como opción en la barra lateral
+YOLO_WEIGHTS_OPTIONS = {
+    "YOLOv8n (rápido)": "yolov8n.pt",
+    "YOLOv8m (más preciso)": "yolov8m.pt",
+}
+YOLO_WEIGHTS = YOLO_WEIGHTS_OPTIONS["YOLOv8n (rápido)"]
+# Exportaciones (ONNX, OpenVINO, TensorRT) persistentes entre arranques del proceso
+YOLO_EXPORT_DIR = Path(os.environ.get("YOLO_EXPORT_DIR", Path.home() / ".cache" / "reconocimiento-inventario" / "yolo"))
+
+# --- FUNCIONES AUXILIARES ---
+def _prep(img, imgsz=640):
+    """Reduce una imagen BGR para que su lado mayor mida `imgsz` px. Devuelve la imagen y la escala aplicada."""
+    import cv2
+    h, w = img.shape[:2]
+    scale = imgsz / max(h, w)
+    if scale >= 1:
+        return img, 1.0
+    return cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_LINEAR), scale
+
+def _fast_crop(data, coords):
+    """
+    Decodifica los bytes (o un memoryview) de una imagen con OpenCV (libjpeg-turbo con SIMD) y
+    devuelve como PIL RGB solo el recorte (x1, y1, x2, y2). El recorte es una vista de NumPy,
+    así que el cambio de canales BGR→RGB solo recorre los píxeles del objeto.
+    Ignora la orientación EXIF igual que run_yolo_cached, para que las cajas coincidan con el recorte.
+    """
+    import cv2
+    bgr = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    x1, y1, x2, y2 = (max(int(c), 0) for c in coords)
+    return Image.fromarray(cv2.cvtColor(bgr[y1:y2, x1:x2], cv2.COLOR_BGR2RGB))
+
+def _set_analysis(source_key, analysis_text, image_name):
+    """
+    Guarda el análisis de Gemini de la fuente indicada. El JSON se interpreta una sola vez
+    aquí y no en cada rerun; `analysis_data_<fuente>` queda en None si el formato es inesperado.
+    """
+    try:
+        # Corrección: Limpiar el string de la respuesta de la IA antes de procesar
+        clean_json_str = analysis_text.strip().replace("```json", "").replace("```", "")
+        analysis_data = json.loads(clean_json_str)
+    except json.JSONDecodeError:
+        analysis_data = None
+    st.session_state[f"analysis_{source_key}"] = analysis_text
+    st.session_state[f"analysis_data_{source_key}"] = analysis_data
+    st.session_state[f"image_name_{source_key}"] = image_name
+
+def _clear_analysis(source_key):
+    """Limpia únicamente el análisis pendiente de la fuente de imagen indicada."""
+    st.session_state.pop(f"analysis_{source_key}", None)
+    st.session_state.pop(f"analysis_data_{source_key}", None)
+    st.session_state.pop(f"image_name_{source_key}", None)
+    st.session_state.pop(f"snapshot_{source_key}", None)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _pie_figure(counts):
+    """Gráfico de tipos de registro. `counts` es una tupla de (tipo, cantidad), así que la figura se construye una vez por conteo."""
+    # Import diferido a propósito: plotly solo se carga si se visita el Dashboard
+    import plotly.express as px
+    names, values = zip(*counts)
+    return px.pie(
+        values=values,
+        names=names,
+        title="Tipos de Registros en el Inventario",
+        color_discrete_sequence=px.colors.sequential.RdBu
+    )
+
 # --- INICIALIZACIÓN DE SERVICIOS (Método robusto con cache) ---
-@st.cache_resource
-def initialize_services():
-    """Carga YOLO e inicializa Firebase y Gemini una sola vez para toda la sesión."""
+def _export_runtime_tag(fmt):
+    """
+    Versiones de las que depende un modelo exportado. Un engine TensorRT solo sirve para
+    la misma GPU y la misma versión de TensorRT con que se construyó.
+    """
+    import torch
+    import ultralytics
+    tag = [f"ultralytics={ultralytics.__version__}"]
+    if fmt == "engine":
+        import tensorrt
+        tag += [f"tensorrt={tensorrt.__version__}", f"gpu={torch.cuda.get_device_name(0)}"]
+    elif fmt == "openvino":
+        import openvino
+        tag.append(f"openvino={openvino.__version__}")
+    return ";".join(tag)
+
+def _export_yolo(weights, fmt, rebuild=False, **export_args):
+    """
+    Exporta los pesos al formato indicado una sola vez y reutiliza el resultado en disco.
+    Las exportaciones se guardan en YOLO_EXPORT_DIR bajo un hash de los pesos, los argumentos
+    de exportación y las versiones del runtime, de modo que sobreviven a reinicios del
+    contenedor y se regeneran si cualquiera de ellos cambia. Con `rebuild` se descarta la
+    exportación existente y se vuelve a generar.
+    """
+    from ultralytics import YOLO
+    model = YOLO(weights)  # Descarga los pesos oficiales la primera vez
+    # ckpt_path es la ruta ya resuelta por Ultralytics (p. ej. dentro de SETTINGS['weights_dir'])
+    ckpt_path = Path(model.ckpt_path or weights)
+    key = json.dumps({"fmt": fmt, "args": export_args, "runtime": _export_runtime_tag(fmt)}, sort_keys=True)
+    digest = hashlib.sha1(ckpt_path.read_bytes() + key.encode()).hexdigest()[:12]
+    export_dir = YOLO_EXPORT_DIR / f"{ckpt_path.stem}-{digest}"
+
+    if fmt == "openvino":
+        # OpenVINO exporta a un directorio en lugar de a un único archivo
+        suffix = "_int8_openvino_model" if export_args.get("int8") else "_openvino_model"
+        target = export_dir / (ckpt_path.stem + suffix)
+    else:
+        target = export_dir / f"{ckpt_path.stem}.{fmt}"
+    if target.exists():
+        if not rebuild:
+            return str(target)
+        if target.is_dir():
+            shutil.rmtree(target)
+        else:
+            target.unlink()
+
+    exported = model.export(format=fmt, imgsz=640, **export_args)
+    export_dir.mkdir(parents=True, exist_ok=True)
+    shutil.move(str(exported), str(target))
+    return str(target)
+
+@st.cache_resource(show_spinner="Exportando modelo YOLO...")
+def get_yolo_source(weights=YOLO_WEIGHTS, rebuild=False):
+    """
+    Devuelve la ruta del modelo exportado con el backend más rápido disponible: un engine
+    TensorRT FP16 si hay CUDA, OpenVINO INT8 (o ONNX Runtime) en CPU. Devuelve None si
+    ninguna exportación es posible. Lo comparten el modelo de la página y la cámara en vivo.
+    Con `rebuild` se regenera la exportación en la misma ruta.
+    """
+    import torch
+    # Exportación con batch dinámico para que YoloBatcher pueda agrupar imágenes.
+    # En CPU se prueba primero OpenVINO INT8 (calibrado con coco128) y después ONNX Runtime.
+    if torch.cuda.is_available():
+        backends = [("engine", {"half": True, "dynamic": True, "batch": 16})]
+    else:
+        backends = [("openvino", {"int8": True, "dynamic": True, "data": "coco128.yaml"}), ("onnx", {"dynamic": True})]
+    for fmt, export_args in backends:
+        try:
+            return _export_yolo(weights, fmt, rebuild=rebuild, **export_args)
+        except Exception as e:
+            logger.warning(f"No se pudo usar el backend '{fmt}' para YOLO: {e}")
+    return None
+
+@st.cache_resource(show_spinner="Cargando modelo YOLO...")
+def load_yolo_model(weights=YOLO_WEIGHTS):
+    """
+    Carga YOLO desde el modelo exportado por get_yolo_source y, si no lo hay, desde los pesos PyTorch
+    originales (fusionados, en FP16 cuando hay CUDA y compilados con torch.compile si el grafo compilado funciona).
+    """
+    import torch
+    from ultralytics import YOLO
+    use_cuda = torch.cuda.is_available()
+    compile_eager = False
+    model = None
+    source = get_yolo_source(weights)
+    if source is not None:
+        try:
+            model = YOLO(source, task="detect")
+        except Exception as e:
+            # Exportación en disco corrupta o incompatible: se regenera una vez antes de usar PyTorch
+            logger.warning(f"No se pudo cargar el modelo exportado '{source}', se vuelve a exportar: {e}")
+            source = get_yolo_source(weights, rebuild=True)
+            if source is not None:
+                try:
+                    model = YOLO(source, task="detect")
+                except Exception as e:
+                    logger.warning(f"No se pudo cargar el modelo reexportado '{source}': {e}")
+    if model is None:
+        logger.warning("Ningún backend exportado está disponible, se usa PyTorch.")
+        model = YOLO(weights)
+        model.fuse()  # Fusiona Conv+BN una sola vez
+        if use_cuda:
+            # Los overrides se aplican a todas las llamadas posteriores del modelo
+            model.overrides.update(half=True, device=0)
+        compile_eager = True
+
+    # Calentamiento: las primeras inferencias pagan la inicialización perezosa del modelo
+    # (contexto CUDA, selección de algoritmos de cuDNN), así que se hacen aquí una sola vez
+    # por proceso y no en el primer clic del usuario. También crean model.predictor.
+    dummy = np.zeros((640, 640, 3), dtype=np.uint8)
     try:
-        yolo_model = YOLO('yolov8m.pt')
-        firebase_handler = FirebaseUtils()
-        gemini_handler = GeminiUtils()
-        return yolo_model, firebase_handler, gemini_handler
+        for _ in range(2):
+            model.predict(dummy, imgsz=640, verbose=False)
     except Exception as e:
-        st.error(f"**Error Crítico de Inicialización.** No se pudo cargar un modelo o conectar a un servicio. Revisa los logs y tus secretos.")
-        st.code(f"Detalle: {e}", language="bash")
-        return None, None, None
+        logger.warning(f"No se pudo calentar el modelo YOLO: {e}")
+        compile_eager = False
+
+    if compile_eager and model.predictor is not None:
+        # Sin backend exportado, torch.compile al menos elimina el despacho dinámico de Python.
+        # Se compila el módulo que ya usa el AutoBackend del predictor (el que ejecuta de verdad
+        # la inferencia) y se comprueba que el grafo compilado funciona antes de quedarse con él.
+        backend = model.predictor.model
+        eager_module = backend.model
+        try:
+            backend.model = torch.compile(eager_module, mode="reduce-overhead", fullgraph=False)
+            for _ in range(2):
+                model.predict(dummy, imgsz=640, verbose=False)
+            logger.info("YOLO compilado con torch.compile.")
+        except Exception as e:
+            logger.warning(f"torch.compile falló al ejecutar YOLO, se usa el modelo sin compilar: {e}")
+            backend.model = eager_module
+    return model
 
-yolo_model, firebase, gemini = initialize_services()
+@st.cache_resource
+def get_yolo_batcher(weights=YOLO_WEIGHTS):
+    """Un único agrupador por modelo, compartido por todas las sesiones del proceso."""
+    from yolo_utils import YoloBatcher
+    return YoloBatcher(load_yolo_model(weights), imgsz=640, verbose=False)
+
+def _decode_for_yolo(img_bytes):
+    """Decodifica los bytes a BGR y los reduce a 640 px. Devuelve la imagen y la escala aplicada."""
+    import cv2
+    # Se ignora la orientación EXIF para que las cajas coincidan con _fast_crop
+    img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    # YOLO trabaja a 640 px: reducir antes evita mover la imagen completa por el preprocesado
+    return _prep(img)
+
+def _to_detections(r, img, scale):
+    """
+    Convierte un resultado de YOLO en el dict cacheable que usa la página de análisis.
+    `img` es la imagen reducida que recibió YOLO; se anota en el sitio porque no se reutiliza.
+    """
+    from yolo_utils import annotate
+    # En CPU .cpu().numpy() comparte memoria con el tensor de Results: se copia antes de reescalar
+    boxes = r.boxes.data.cpu().numpy().copy()
+    plot = annotate(img, boxes, r.names)
+    boxes[:, :4] /= scale  # Coordenadas en la resolución original para el recorte
+    return {"boxes": boxes, "names": r.names, "plot": plot}
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def run_yolo_cached(img_bytes: bytes, weights: str = YOLO_WEIGHTS) -> dict:
+    """
+    Ejecuta YOLO una sola vez por contenido de imagen y modelo, de modo que los reruns
+    de Streamlit sobre la misma foto no repiten la inferencia.
+    Devuelve las cajas como array (x1, y1, x2, y2, conf, cls) en coordenadas de la
+    imagen original, los nombres de clase y la imagen anotada (reducida) en BGR.
+    """
+    img, scale = _decode_for_yolo(img_bytes)
+    return _to_detections(get_yolo_batcher(weights).submit_and_wait(img), img, scale)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def run_yolo_batch_cached(images: tuple, weights: str = YOLO_WEIGHTS) -> list:
+    """
+    Variante de run_yolo_cached para varias imágenes: se encolan todas a la vez en el
+    YoloBatcher para que YOLO las procese en una sola llamada por lotes.
+    """
+    decoded = [_decode_for_yolo(img_bytes) for img_bytes in images]
+    batcher = get_yolo_batcher(weights)
+    futures = [batcher.submit(img) for img, _ in decoded]
+    return [_to_detections(future.result(), img, scale) for future, (img, scale) in zip(futures, decoded)]
+
+@st.cache_data(ttl=30, show_spinner=False)
+def get_items_cached(limit=None, start_after=None):
+    """
+    Lectura paginada del inventario para la Base de Datos.
+    Se invalida con _invalidate_inventory_cache() tras guardar, eliminar o refrescar.
+    """
+    return firebase.get_all_inventory_items(limit=limit, start_after=start_after)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def count_items_cached(tipos=None):
+    """Conteo agregado en Firestore por tipo (tupla de tipos, o None para el total)."""
+    return firebase.count_by_tipo(tipos)
+
+@st.cache_data(ttl=30, show_spinner=False)
+def get_dashboard_cached():
+    """
+    Lectura del inventario y agregados del Dashboard en un único artefacto cacheado:
+    conteo por tipo y los 10 registros más recientes. Los reruns no vuelven a recorrer
+    los artículos ni a hashear una clave del tamaño del inventario.
+    Devuelve (hay_artículos, df_recent, type_counts); los dos últimos son None si ningún
+    artículo tiene 'timestamp' y 'tipo'.
+    """
+    import pandas as pd
+    items = firebase.get_all_inventory_items()
+    # --- CORRECCIÓN DEL ERROR 'timestamp' ---
+    rows = [
+        (item['id'], item['timestamp'], item['tipo'], item.get('name'), item.get('custom_id'))
+        for item in items if 'timestamp' in item and 'tipo' in item
+    ]
+    if not rows:
+        return bool(items), None, None
+    df = pd.DataFrame(rows, columns=['id', 'timestamp', 'tipo', 'name', 'custom_id'])
+    # Los timestamps son ISO 8601 (get_timestamp): con el formato explícito pandas usa su parser en C.
+    # Un valor mal formado queda como NaT (fuera de la actividad reciente) en lugar de romper el Dashboard
+    df['timestamp'] = pd.to_datetime(df['timestamp'], format='ISO8601', errors='coerce', cache=True)
+    # nlargest selecciona los 10 más recientes sin ordenar todo el inventario
+    df_recent = df.nlargest(10, 'timestamp')
+    return True, df_recent[['timestamp', 'tipo', 'name', 'custom_id']], df['tipo'].value_counts()
+
+def _invalidate_inventory_cache():
+    """Descarta las lecturas y conteos cacheados tras guardar, eliminar o refrescar."""
+    get_items_cached.clear()
+    count_items_cached.clear()
+    get_dashboard_cached.clear()
+
+@st.cache_resource
+def get_gemini_cache():
+    """Análisis de Gemini por (sha1 del JPEG del recorte, descripción), compartidos entre sesiones."""
+    return AnalysisCache(max_entries=256, ttl=3600)
+
+@st.cache_resource
+def get_gemini_executor():
+    """Hilos de trabajo para las llamadas a Gemini, fuera del hilo que ejecuta el script."""
+    return ThreadPoolExecutor(max_workers=4)
+
+def _stream_into(gemini, image, description, chunks):
+    """Consume la respuesta en streaming de Gemini dejando cada fragmento en `chunks`. Devuelve el texto completo."""
+    for chunk in gemini.analyze_image_stream(image, description):
+        chunks.append(chunk)
+    return "".join(chunks) or json.dumps({"error": "No se pudo analizar la imagen"})
+
+@st.fragment(run_every=0.5)
+def _gemini_job_status(source_key):
+    """
+    Muestra el progreso del análisis en curso de la fuente indicada. Solo este fragmento se
+    vuelve a ejecutar mientras Gemini responde; al terminar guarda el resultado y recarga la página.
+    """
+    ss = st.session_state
+    job = ss.get(f"gemini_job_{source_key}")
+    if job is None:
+        return
+    st.caption(f"🤖 Gemini está analizando el recorte de '{job['class_name']}'...")
+    st.code("".join(job["chunks"]), language="json")
+    if job["future"].done():
+        try:
+            analysis_text = job["future"].result()
+        except Exception as e:
+            analysis_text = json.dumps({"error": str(e)})
+        _set_analysis(source_key, analysis_text, job["image_name"])
+        # Solo se cachea un JSON válido sin clave "error": un fallo (o un stream cortado a
+        # medias) no se cachea, para que un reintento vuelva a llamar a Gemini
+        analysis_data = ss[f"analysis_data_{source_key}"]
+        if isinstance(analysis_data, dict) and "error" not in analysis_data:
+            get_gemini_cache().set(job["cache_key"], analysis_text)
+        ss.pop(f"gemini_job_{source_key}")
+        st.rerun()
 
-if not all([yolo_model, firebase, gemini]):
+@st.cache_resource(show_spinner="Conectando con Firebase...")
+def get_firebase():
+    """Cliente de Firebase compartido por todas las sesiones del proceso."""
+    return FirebaseUtils()
+
+@st.cache_resource(show_spinner="Conectando con Gemini...")
+def get_gemini():
+    """Cliente de Gemini compartido por todas las sesiones del proceso."""
+    return GeminiUtils()
+
+# Cada servicio se cachea por separado y los fallos no se cachean: si uno no se puede
+# inicializar, el siguiente rerun lo reintenta sin volver a crear el otro.
+try:
+    firebase = get_firebase()
+    gemini = get_gemini()
+except Exception as e:
+    st.error(f"**Error Crítico de Inicialización.** No se pudo conectar a un servicio. Revisa los logs y tus secretos.")
+    st.code(f"Detalle: {e}", language="bash")
     st.stop()
 
 # --- BARRA LATERAL DE NAVEGÁCIÓN ---
@@ -55,6 +398,101 @@ page = st.sidebar.radio(
     ["🏠 Inicio", "📸 Análisis de Imagen", "🗃️ Base de Datos", "📊 Dashboard", "👥 Acerca de"]
 )
 
+yolo_weights = YOLO_WEIGHTS_OPTIONS[st.sidebar.selectbox("Modelo de detección (YOLO):", list(YOLO_WEIGHTS_OPTIONS))]
+
+@st.fragment
+def _inventory_listing():
+    """
+    Listado paginado del inventario en la Base de Datos. Al ser un fragmento, paginar,
+    seleccionar filas o eliminarlas solo vuelve a ejecutar este bloque y no toda la app.
+    """
+    st.subheader("Inventario Actual")
+
+    if st.button("🔄 Refrescar Datos"):
+        _invalidate_inventory_cache()
+        st.rerun(scope="fragment")
+
+    # Paginación: solo se pide a Firestore la página visible. `db_page_cursors` guarda
+    # el (timestamp, id) del último artículo de cada página anterior.
+    ss = st.session_state
+    page_size = st.number_input("Artículos por página", min_value=5, max_value=100, value=25, step=5)
+    if ss.get('db_page_size') != page_size:
+        ss.db_page_size = page_size
+        ss.db_page_cursors = []
+    ss.setdefault('db_page_cursors', [])
+    start_after = ss.db_page_cursors[-1] if ss.db_page_cursors else None
+    page_num = len(ss.db_page_cursors) + 1
+
+    try:
+        with st.spinner("Cargando datos desde Firebase..."):
+            items = get_items_cached(limit=page_size, start_after=start_after)
+        
+        if items:
+            import pandas as pd  # Import diferido: solo se usa para la tabla del inventario
+
+            st.info(f"Página **{page_num}**: mostrando **{len(items)}** registros del inventario.")
+            # Una sola tabla para toda la página; el JSON completo solo se muestra para las filas seleccionadas
+            df = pd.DataFrame(items).reindex(columns=['custom_id', 'name', 'quantity', 'tipo', 'timestamp'])
+            ss.setdefault('db_table_version', 0)
+            event = st.dataframe(
+                df,
+                on_select="rerun",
+                selection_mode="multi-row",
+                hide_index=True,
+                use_container_width=True,
+                # La página forma parte de la clave: cada página tiene su propia selección
+                key=f"inventory_table_{page_num}_{ss.db_table_version}",
+            )
+
+            selected = [items[i] for i in event.selection.rows if i < len(items)]
+            for item in selected:
+                header = item.get('custom_id') or item.get('name', item['id'])
+                with st.expander(f"📦 **{header}** (Cantidad: {item.get('quantity', 'N/A')})", expanded=True):
+                    st.json(item)
+
+            if selected and st.button(f"🗑️ Eliminar seleccionados ({len(selected)})", type="primary"):
+                try:
+                    firebase.bulk_delete([item['id'] for item in selected])
+                except Exception as e:
+                    # Algunos borrados pueden haberse aplicado: se invalida igualmente la caché
+                    _invalidate_inventory_cache()
+                    st.error(f"Error al eliminar: {e}")
+                else:
+                    _invalidate_inventory_cache()
+                    st.success(f"Se eliminaron {len(selected)} registro(s).")
+                    # Nueva clave de la tabla para descartar la selección anterior
+                    ss.db_table_version += 1
+                    st.rerun(scope="fragment")
+        elif page_num == 1:
+            st.warning("El inventario está vacío.")
+        else:
+            st.info("No hay más registros en esta página.")
+
+        col_prev, col_next = st.columns(2)
+        if col_prev.button("⬅️ Página anterior", disabled=page_num == 1, use_container_width=True):
+            ss.db_page_cursors.pop()
+            st.rerun(scope="fragment")
+        if col_next.button("Página siguiente ➡️", disabled=len(items) < page_size, use_container_width=True):
+            ss.db_page_cursors.append((items[-1]['timestamp'], items[-1]['id']))
+            st.rerun(scope="fragment")
+            
+    except Exception as e:
+        st.error(f"No se pudo conectar con la base de datos: {e}")
+
+    # Migración puntual, fuera de la lectura: los registros antiguos sin 'timestamp'
+    # no aparecen en el listado ordenado hasta que se les asigna uno.
+    with st.expander("🛠️ Mantenimiento"):
+        st.caption("Asigna a los registros sin 'timestamp' su fecha de creación en Firestore para que aparezcan en el listado.")
+        if st.button("Completar timestamps faltantes"):
+            try:
+                with st.spinner("Revisando el inventario..."):
+                    updated = firebase.backfill_missing_timestamps()
+                if updated:
+                    _invalidate_inventory_cache()
+                st.success(f"Se actualizaron {updated} registro(s).")
+            except Exception as e:
+                st.error(f"No se pudieron completar los timestamps: {e}")
+
 # --- LÓGICA DE LAS PÁGINAS ---
 
 if page == "🏠 Inicio":
@@ -64,10 +502,10 @@ if page == "🏠 Inicio":
     st.markdown("---")
 
     try:
-        items = firebase.get_all_inventory_items()
-        item_count = len(items)
-        image_items = sum(1 for item in items if item.get("tipo") in ["camera", "imagen"])
-        manual_items = sum(1 for item in items if item.get("tipo") == "manual")
+        # Conteos agregados en el servidor: no se descargan los documentos del inventario
+        item_count = count_items_cached()
+        image_items = count_items_cached(("camera", "imagen"))
+        manual_items = count_items_cached(("manual",))
 
         col1, col2, col3 = st.columns(3)
         col1.metric("📦 Total de Artículos Registrados", item_count)
@@ -89,29 +527,75 @@ if page == "🏠 Inicio":
 
 elif page == "📸 Análisis de Imagen":
     st.header("📸 Detección y Análisis de Objetos por Imagen")
+    ss = st.session_state
 
-    if 'analysis_in_progress' in st.session_state and st.session_state.analysis_in_progress:
+    # YOLO solo se carga (y exporta) al entrar en esta página: el resto de secciones no lo usan
+    try:
+        load_yolo_model(yolo_weights)
+    except Exception as e:
+        st.error(f"**Error Crítico de Inicialización.** No se pudo cargar el modelo YOLO. Revisa los logs.")
+        st.code(f"Detalle: {e}", language="bash")
+        st.stop()
+
+    # Cada fuente de imagen guarda su propio análisis para no mezclar resultados entre ellas
+    img_source = st.radio("Elige la fuente de la imagen:", ["Cámara en vivo", "Subir un archivo"], horizontal=True)
+    source_key = "camera" if img_source == "Cámara en vivo" else "imagen"
+    analysis_key = f"analysis_{source_key}"
+    ss.setdefault(analysis_key, None)
+
+    pending_batch = ss.get('pending_batch', [])
+    if pending_batch:
+        with st.container(border=True):
+            st.write(f"📦 **Lote pendiente ({len(pending_batch)}):** " + ", ".join(item['custom_id'] for item in pending_batch))
+            col_save_batch, col_discard_batch = st.columns(2)
+            if col_save_batch.button("💾 Guardar lote", type="primary", use_container_width=True):
+                try:
+                    with st.spinner("Guardando lote..."):
+                        firebase.save_inventory_items_bulk(pending_batch)
+                    _invalidate_inventory_cache()
+                    ss.pending_batch = []
+                    st.rerun()
+                except ValueError as e:
+                    st.error(str(e))
+                except Exception as e:
+                    st.error(f"Ocurrió un error inesperado: {e}")
+            if col_discard_batch.button("Descartar lote", use_container_width=True):
+                ss.pending_batch = []
+                st.rerun()
+
+    gemini_job = ss.get(f"gemini_job_{source_key}")
+    if gemini_job:
+        # El recorte se pinta fuera del fragmento para no reenviarlo en cada sondeo
+        st.image(gemini_job["crop"], caption=f"Recorte de '{gemini_job['class_name']}' enviado para análisis...")
+        _gemini_job_status(source_key)
+
+    if ss[analysis_key]:
         st.subheader("✔️ Resultado del Análisis de Gemini")
-        analysis_text = st.session_state.last_analysis
-        
-        try:
-            # Corrección: Limpiar el string de la respuesta de la IA antes de procesar
-            clean_json_str = analysis_text.strip().replace("```json", "").replace("```", "")
-            analysis_data = json.loads(clean_json_str)
-            
+        analysis_text = ss[analysis_key]
+        analysis_data = ss.get(f"analysis_data_{source_key}")
+
+        if analysis_data is not None:
             if "error" not in analysis_data:
                 # --- NUEVO: Visualización en texto normal ---
-                st.markdown('<div class="report-box">', unsafe_allow_html=True)
-                st.write(f"<span class='report-header'>Elemento Identificado:</span> <span class='report-data'>{analysis_data.get('elemento_identificado', 'No especificado')}</span>", unsafe_allow_html=True)
-                st.write(f"<span class='report-header'>Cantidad Detectada:</span> <span class='report-data'>{analysis_data.get('cantidad_aproximada', 'No especificada')}</span>", unsafe_allow_html=True)
-                st.write(f"<span class='report-header'>Estado Aparente:</span> <span class='report-data'>{analysis_data.get('estado_condicion', 'No especificado')}</span>", unsafe_allow_html=True)
-                st.write(f"<span class='report-header'>Categoría Sugerida:</span> <span class='report-data'>{analysis_data.get('posible_categoria_de_inventario', 'No especificada')}</span>", unsafe_allow_html=True)
-                
+                # El informe se emite en un único bloque HTML: un solo mensaje al navegador
+                # y el <div> envuelve de verdad a su contenido
+                rows = [
+                    ("Elemento Identificado", analysis_data.get('elemento_identificado', 'No especificado')),
+                    ("Cantidad Detectada", analysis_data.get('cantidad_aproximada', 'No especificada')),
+                    ("Estado Aparente", analysis_data.get('estado_condicion', 'No especificado')),
+                    ("Categoría Sugerida", analysis_data.get('posible_categoria_de_inventario', 'No especificada')),
+                ]
+                report_html = "".join(
+                    f"<p><span class='report-header'>{label}:</span> <span class='report-data'>{value}</span></p>"
+                    for label, value in rows
+                )
                 features = analysis_data.get('caracteristicas_distintivas', [])
                 if features:
-                    st.markdown("<span class='report-header'>Características Notables:</span>", unsafe_allow_html=True)
-                    st.markdown(f"- {features}")
-                st.markdown('</div>', unsafe_allow_html=True)
+                    if not isinstance(features, list):
+                        features = [features]
+                    report_html += "<span class='report-header'>Características Notables:</span><ul>"
+                    report_html += "".join(f"<li>{feature}</li>" for feature in features) + "</ul>"
+                st.markdown(f'<div class="report-box">{report_html}</div>', unsafe_allow_html=True)
 
                 # --- NUEVO: Formulario de guardado avanzado ---
                 with st.form("save_to_db_form"):
@@ -120,85 +604,140 @@ elif page == "📸 Análisis de Imagen":
                     description = st.text_input("Descripción del Producto:", value=analysis_data.get('elemento_identificado', ''))
                     quantity = st.number_input("Unidades Existentes:", min_value=1, value=analysis_data.get('cantidad_aproximada', 1), step=1)
                     
-                    submitted = st.form_submit_button("Añadir a la Base de Datos")
+                    col_submit, col_queue = st.columns(2)
+                    submitted = col_submit.form_submit_button("Añadir a la Base de Datos")
+                    queued = col_queue.form_submit_button("Añadir al lote")
 
-                    if submitted:
+                    if submitted or queued:
                         if not custom_id or not description:
                             st.warning("El ID Personalizado y la Descripción son obligatorios.")
                         else:
-                            with st.spinner("Guardando..."):
-                                data_to_save = {
-                                    "custom_id": custom_id,
-                                    "name": description, # 'name' para compatibilidad con el listado
-                                    "quantity": quantity,
-                                    "tipo": "imagen" if hasattr(st.session_state, 'last_image_name') else "camera",
-                                    "analisis_ia": analysis_data,
-                                    "timestamp": firebase.get_timestamp()
-                                }
-                                firebase.save_inventory_item(data_to_save, custom_id)
-                                st.success(f"¡Artículo '{description}' con ID '{custom_id}' guardado con éxito!")
-                                st.session_state.analysis_in_progress = False
-                                st.rerun()
+                            data_to_save = {
+                                "custom_id": custom_id,
+                                "name": description, # 'name' para compatibilidad con el listado
+                                "quantity": quantity,
+                                "tipo": source_key,
+                                "analisis_ia": analysis_data,
+                                "timestamp": firebase.get_timestamp()
+                            }
+                            if queued:
+                                # Se acumula en memoria y se escribe junto con el resto con "Guardar lote"
+                                ss.setdefault('pending_batch', []).append(data_to_save)
+                            else:
+                                with st.spinner("Guardando..."):
+                                    firebase.save_inventory_item(data_to_save, custom_id)
+                                    _invalidate_inventory_cache()
+                                    st.success(f"¡Artículo '{description}' con ID '{custom_id}' guardado con éxito!")
+                            _clear_analysis(source_key)
+                            st.rerun()
 
             else:
                  st.error(f"Error en el análisis de Gemini: {analysis_data['error']}")
 
-        except json.JSONDecodeError:
+        else:
             st.error("La IA devolvió una respuesta con formato inesperado.")
             with st.expander("Ver detalles técnicos (respuesta sin procesar)"):
                 st.code(analysis_text, language='text')
 
         # Botón para volver a analizar
         if st.button("↩️ Analizar otra imagen"):
-            st.session_state.analysis_in_progress = False
+            _clear_analysis(source_key)
             st.rerun()
 
     else:
         # Interfaz para capturar o subir la imagen
-        img_source = st.radio("Elige la fuente de la imagen:", ["Cámara en vivo", "Subir un archivo"], horizontal=True)
         img_buffer = None
-        if img_source == "Cámara en vivo":
-            img_buffer = st.camera_input("Apunta la cámara a los objetos", key="camera_input")
+        detections = None
+        if source_key == "camera":
+            try:
+                from streamlit_webrtc import webrtc_streamer
+                from webrtc_utils import YoloVideoProcessor, RTC_CONFIGURATION
+            except ImportError:
+                webrtc_streamer = None
+
+            if webrtc_streamer is None:
+                img_buffer = st.camera_input("Apunta la cámara a los objetos", key="camera_input")
+            else:
+                # Detección continua por WebRTC; Gemini solo se usa sobre un fotograma capturado.
+                # Cada sesión usa el mismo modelo exportado que la página (o los pesos .pt si no hay).
+                live_source = get_yolo_source(yolo_weights) or yolo_weights
+                ctx = webrtc_streamer(
+                    key="yolo_live",
+                    video_processor_factory=lambda: YoloVideoProcessor(live_source),
+                    rtc_configuration=RTC_CONFIGURATION,
+                    media_stream_constraints={"video": True, "audio": False},
+                )
+                if ctx.video_processor and st.button("📸 Capturar fotograma para analizar"):
+                    snapshot = ctx.video_processor.get_snapshot()
+                    if snapshot is not None:
+                        ss["snapshot_camera"] = snapshot
+                if ss.get("snapshot_camera"):
+                    img_buffer = io.BytesIO(ss["snapshot_camera"])
         else:
-            img_buffer = st.file_uploader("Sube un archivo de imagen", type=['png', 'jpg', 'jpeg'], key="file_uploader")
+            uploaded_files = st.file_uploader("Sube uno o varios archivos de imagen", type=['png', 'jpg', 'jpeg'], accept_multiple_files=True, key="file_uploader")
+            if len(uploaded_files) > 1:
+                # Todas las imágenes se detectan en una sola llamada por lotes a YOLO
+                with st.spinner(f"🧠 Detectando objetos en {len(uploaded_files)} imágenes con IA local (YOLO)..."):
+                    batch_detections = run_yolo_batch_cached(tuple(f.getvalue() for f in uploaded_files), yolo_weights)
+                selected_idx = st.selectbox(
+                    "Imagen a revisar:",
+                    range(len(uploaded_files)),
+                    format_func=lambda i: f"{uploaded_files[i].name} ({len(batch_detections[i]['boxes'])} objetos)"
+                )
+                img_buffer, detections = uploaded_files[selected_idx], batch_detections[selected_idx]
+            elif uploaded_files:
+                img_buffer = uploaded_files[0]
 
         if img_buffer:
-            pil_image = Image.open(img_buffer)
-            
-            with st.spinner("🧠 Detectando objetos con IA local (YOLO)..."):
-                results = yolo_model(pil_image)
+            if detections is None:
+                with st.spinner("🧠 Detectando objetos con IA local (YOLO)..."):
+                    detections = run_yolo_cached(img_buffer.getvalue(), yolo_weights)
 
             st.subheader("🔍 Objetos Detectados")
-            annotated_image = results[0].plot()
-            annotated_image_rgb = cv2.cvtColor(annotated_image, cv2.COLOR_BGR2RGB)
-            st.image(annotated_image_rgb, caption="Imagen con objetos detectados por YOLO.", use_container_width=True)
+            # st.image invierte los canales por sí mismo: no hace falta una copia con cv2.cvtColor
+            st.image(detections["plot"], channels="BGR", caption="Imagen con objetos detectados por YOLO.", use_container_width=True)
 
-            detections = results[0]
+            boxes, names = detections["boxes"], detections["names"]
             
-            if detections.boxes:
-                detected_classes = [detections.names[c] for c in detections.boxes.cls.tolist()]
-                counts = Counter(detected_classes)
-                st.write("**Conteo en la escena:**")
-                st.table(counts)
-            else:
-                st.info("No se detectaron objetos conocidos en la imagen.")
+            # Un único bloque markdown en lugar de varios elementos por conteo
+            counts = Counter(names[int(c)] for c in boxes[:, 5])
+            st.markdown(
+                "**Conteo en la escena:**\n" + "\n".join(f"- {name}: {n}" for name, n in counts.items())
+                if counts else "_No se detectaron objetos conocidos en la imagen._"
+            )
 
             st.subheader("▶️ Analizar un objeto en detalle con Gemini")
-            if detections.boxes:
-                for i, box in enumerate(detections.boxes):
-                    class_name = detections.names[box.cls[0].item()]
+            if len(boxes):
+                for i, box in enumerate(boxes):
+                    class_name = names[int(box[5])]
                     if st.button(f"Analizar '{class_name}' #{i+1}", key=f"classify_{i}", use_container_width=True):
-                        coords = box.xyxy[0].cpu().numpy().astype(int)
-                        cropped_pil_image = pil_image.crop(tuple(coords))
-                        
-                        st.image(cropped_pil_image, caption=f"Recorte de '{class_name}' enviado para análisis...")
-
-                        with st.spinner("🤖 Gemini está analizando el recorte..."):
-                            analysis_text = gemini.analyze_image(cropped_pil_image, f"Objeto detectado como {class_name}")
-                            st.session_state.last_analysis = analysis_text
-                            st.session_state.last_image_name = img_buffer.name if hasattr(img_buffer, 'name') else f"camera_{firebase.get_timestamp()}.jpg"
-                            st.session_state.analysis_in_progress = True
-                            st.rerun()
+                        # La imagen completa solo se decodifica cuando se pide un recorte
+                        # getbuffer() expone los bytes del archivo sin copiarlos
+                        cropped_pil_image = _fast_crop(img_buffer.getbuffer(), box[:4])
+
+                        # El recorte se reduce y codifica en JPEG una sola vez: esos bytes se envían
+                        # a Gemini tal cual y su hash es la clave de la caché
+                        gemini_jpeg = compress_for_gemini(cropped_pil_image)
+                        gemini_description = f"Objeto detectado como {class_name}"
+                        cache_key = (hashlib.sha1(gemini_jpeg).hexdigest(), gemini_description)
+                        analysis_text = get_gemini_cache().get(cache_key)
+                        image_name = img_buffer.name if hasattr(img_buffer, 'name') else f"camera_{firebase.get_timestamp()}.jpg"
+
+                        if analysis_text is None:
+                            # La llamada corre en un hilo de trabajo; _gemini_job_status muestra la
+                            # respuesta a medida que llega sin bloquear el resto de la página
+                            chunks = []
+                            ss[f"gemini_job_{source_key}"] = {
+                                "future": get_gemini_executor().submit(_stream_into, gemini, gemini_jpeg, gemini_description, chunks),
+                                "chunks": chunks,
+                                "cache_key": cache_key,
+                                "class_name": class_name,
+                                "crop": gemini_jpeg,
+                                "image_name": image_name,
+                            }
+                        else:
+                            _set_analysis(source_key, analysis_text, image_name)
+                        st.rerun()
 
 elif page == "🗃️ Base de Datos":
     st.header("🗃️ Gestión de la Base de Datos")
@@ -224,6 +763,7 @@ elif page == "🗃️ Base de Datos":
                     }
                     try:
                         firebase.save_inventory_item(data_to_save, manual_custom_id)
+                        _invalidate_inventory_cache()
                         st.success(f"Artículo '{manual_name}' guardado con éxito.")
                     except ValueError as e:
                         st.error(str(e))
@@ -231,64 +771,23 @@ elif page == "🗃️ Base de Datos":
                         st.error(f"Ocurrió un error inesperado: {e}")
 
     st.markdown("---")
-    st.subheader("Inventario Actual")
-
-    if st.button("🔄 Refrescar Datos"):
-        st.rerun()
-
-    try:
-        with st.spinner("Cargando datos desde Firebase..."):
-            items = firebase.get_all_inventory_items()
-        
-        if items:
-            st.info(f"Se encontraron **{len(items)}** registros en el inventario.")
-            for item in items:
-                header = item.get('custom_id') or item.get('name', item['id'])
-                with st.expander(f"📦 **{header}** (Cantidad: {item.get('quantity', 'N/A')})"):
-                    st.json(item)
-                    if st.button("🗑️ Eliminar", key=f"delete_{item['id']}", type="primary"):
-                        firebase.delete_inventory_item(item['id'])
-                        st.success(f"Registro '{header}' eliminado.")
-                        st.rerun()
-        else:
-            st.warning("El inventario está vacío.")
-            
-    except Exception as e:
-        st.error(f"No se pudo conectar con la base de datos: {e}")
+    _inventory_listing()
 
 elif page == "📊 Dashboard":
     st.header("📊 Dashboard del Inventario")
     try:
         with st.spinner("Generando estadísticas..."):
-            items = firebase.get_all_inventory_items()
+            has_items, df_recent, type_counts = get_dashboard_cached()
         
-        if items:
-            # --- CORRECCIÓN DEL ERROR 'timestamp' ---
-            valid_items = [item for item in items if 'timestamp' in item and 'tipo' in item]
-            if not valid_items:
+        if has_items:
+            if df_recent is None:
                  st.warning("No hay registros con datos suficientes para generar un dashboard.")
             else:
-                df = pd.DataFrame(valid_items)
-                df['timestamp'] = pd.to_datetime(df['timestamp'])
-                
                 st.subheader("Distribución de Registros por Tipo")
-                type_counts = df['tipo'].value_counts()
-                fig_pie = px.pie(
-                    type_counts, 
-                    values=type_counts.values, 
-                    names=type_counts.index, 
-                    title="Tipos de Registros en el Inventario",
-                    color_discrete_sequence=px.colors.sequential.RdBu
-                )
-                st.plotly_chart(fig_pie, use_container_width=True)
+                st.plotly_chart(_pie_figure(tuple(type_counts.items())), use_container_width=True)
 
                 st.subheader("Actividad Reciente en el Inventario")
-                df_recent = df.sort_values('timestamp', ascending=False).head(10)
-                display_cols = ['timestamp', 'tipo']
-                if 'name' in df_recent.columns: display_cols.append('name')
-                if 'custom_id' in df_recent.columns: display_cols.append('custom_id')
-
-                st.dataframe(df_recent[display_cols], use_container_width=True)
+                st.dataframe(df_recent, use_container_width=True)
         else:
             st.warning("No hay datos en el inventario para generar un dashboard.")
 
@@ -0,0 +1,89 @@
+import queue
+import logging
+import threading
+import av
+import cv2
+import numpy as np
+from streamlit_webrtc import VideoProcessorBase
+from ultralytics import YOLO
+from yolo_utils import annotate
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Servidor STUN público para establecer la conexión WebRTC con el navegador
+RTC_CONFIGURATION = {"iceServers": [{"urls": ["stun:stun.l.google.com:19302"]}]}
+
+class YoloVideoProcessor(VideoProcessorBase):
+    """
+    Ejecuta YOLO sobre los fotogramas recibidos por WebRTC y devuelve el fotograma anotado.
+    La recepción y la inferencia van en hilos separados: `recv` solo deja el fotograma en una
+    cola de un elemento y devuelve la última anotación disponible, de modo que la captura
+    no espera a YOLO y los fotogramas atrasados se descartan.
+    """
+
+    def __init__(self, source):
+        """`source` es el modelo exportado (TensorRT, OpenVINO u ONNX) o, en su defecto, los pesos .pt."""
+        # Modelo propio del procesador: el predictor de Ultralytics no es seguro entre hilos
+        self.model = YOLO(source, task="detect")
+        if str(source).endswith(".pt"):
+            self.model.fuse()  # Fusiona Conv+BN una sola vez
+        # Calentamiento antes del primer fotograma, con el mismo tamaño que la inferencia en vivo
+        try:
+            self.model.predict(np.zeros((320, 320, 3), dtype=np.uint8), imgsz=320, verbose=False)
+        except Exception as e:
+            logger.warning(f"No se pudo calentar el modelo YOLO de la cámara en vivo: {e}")
+        self._lock = threading.Lock()
+        self._last_frame = None
+        # Búfer de anotación reutilizado entre fotogramas; solo se reserva de nuevo si cambia la resolución
+        self._annotated = None
+        self._frames = queue.Queue(maxsize=1)
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._infer_loop, daemon=True)
+        self._worker.start()
+
+    def _infer_loop(self):
+        while not self._stop.is_set():
+            try:
+                img = self._frames.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                r = self.model.predict(img, imgsz=320, verbose=False)[0]
+                boxes = r.boxes.data.cpu().numpy()
+            except Exception as e:
+                # Un fotograma fallido no debe matar el hilo: se registra y se sigue con el siguiente
+                logger.error(f"Error en la inferencia de YOLO sobre un fotograma WebRTC: {e}")
+                continue
+            with self._lock:
+                if self._annotated is None or self._annotated.shape != img.shape:
+                    self._annotated = np.empty_like(img)
+                # `img` sigue siendo el último fotograma para las capturas: se anota una copia
+                np.copyto(self._annotated, img)
+                annotate(self._annotated, boxes, r.names)
+
+    def recv(self, frame):
+        img = frame.to_ndarray(format="bgr24")
+        with self._lock:
+            self._last_frame = img
+            # from_ndarray copia los píxeles al fotograma, así que el búfer puede reutilizarse
+            out = av.VideoFrame.from_ndarray(self._annotated if self._annotated is not None else img, format="bgr24")
+        # Si el hilo de inferencia sigue ocupado se reemplaza el fotograma pendiente
+        try:
+            self._frames.get_nowait()
+        except queue.Empty:
+            pass
+        self._frames.put_nowait(img)
+        return out
+
+    def on_ended(self):
+        self._stop.set()
+
+    def get_snapshot(self):
+        """Devuelve el último fotograma recibido codificado en JPEG, o None si aún no hay ninguno."""
+        with self._lock:
+            frame = self._last_frame
+        if frame is None:
+            return None
+        ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        return buf.tobytes() if ok else None
@@ -0,0 +1,86 @@
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future
+import numpy as np
+import torch
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Un color BGR fijo por clase para las cajas anotadas (semilla fija: mismos colores en cada arranque)
+CLASS_COLORS = np.random.RandomState(0).randint(0, 255, (256, 3)).tolist()
+
+def annotate(img, boxes, names):
+    """
+    Dibuja las cajas (x1, y1, x2, y2, conf, cls) directamente sobre `img` (BGR).
+    Sustituye a Results.plot(), que copia la imagen y la anota con el Annotator de Ultralytics.
+    """
+    import cv2
+    xyxy = boxes[:, :4].astype(np.int32).tolist()
+    classes = boxes[:, 5].astype(np.int32).tolist()
+    labels = [f"{names[c]} {conf:.2f}" for c, conf in zip(classes, boxes[:, 4].tolist())]
+    for (x1, y1, x2, y2), c, label in zip(xyxy, classes, labels):
+        color = CLASS_COLORS[c % len(CLASS_COLORS)]
+        cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
+        cv2.putText(img, label, (x1, max(y1 - 5, 12)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, cv2.LINE_AA)
+    return img
+
+class YoloBatcher:
+    """
+    Agrupa las imágenes que llegan desde varias sesiones de Streamlit en una sola
+    llamada por lotes a YOLO. Un hilo de fondo espera hasta `max_wait` segundos o
+    hasta reunir `max_batch` imágenes y luego resuelve el Future de cada petición.
+    """
+
+    def __init__(self, model, max_batch=16, max_wait=0.02, **predict_args):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.predict_args = predict_args
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="yolo-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, image):
+        """Encola una imagen sin bloquear y devuelve el Future con su resultado de YOLO."""
+        future = Future()
+        self._queue.put((image, future))
+        return future
+
+    def submit_and_wait(self, image, timeout=None):
+        """Encola una imagen y bloquea hasta obtener su resultado de YOLO."""
+        return self.submit(image).result(timeout)
+
+    def _collect_batch(self):
+        """Bloquea hasta la primera petición y agrega las que lleguen dentro de la ventana."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _infer(self, images):
+        """Llama al modelo sin registro de autograd; inference_mode es local al hilo, por eso se activa aquí."""
+        with torch.inference_mode():
+            return self.model(images, **self.predict_args)
+
+    def _run(self):
+        while True:
+            images, futures = zip(*self._collect_batch())
+            try:
+                results = self._infer(list(images))
+            except Exception as e:
+                logger.error(f"Error en la inferencia por lotes de YOLO: {e}")
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)